@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import datetime as dt
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mpl2nc
+
+STAGES = ['parse', 'process_mpl', 'read_mpl', 'process_nrb', 'write']
+
+# Stages whose output is the input of a stage.
+DEPENDS = {
+    'process_mpl': ['parse'],
+    'process_nrb': ['read_mpl'],
+    'write': ['read_mpl', 'process_nrb'],
+}
+
+# The record dtype is built here rather than with mpl2nc.mpl_dtype, so that
+# versions of mpl2nc without it can be benchmarked.
+def mpl_dtype(bins):
+    return np.dtype(
+        [(x[0], '<' + mpl2nc.NC_TYPE[x[1]]) for x in mpl2nc.HEADER_MPL] +
+        [(x, '<f4', (bins,)) for x in ['channel_1', 'channel_2']]
+    )
+
+def write_mpl(filename, profiles=1000, bins=2000, channels=2, interval=10,
+    bin_time=2e-7, seed=0):
+    rng = np.random.default_rng(seed)
+    a = np.zeros(profiles, mpl_dtype(bins))
+    t = np.datetime64('2020-01-01T00:00:00') + \
+        np.arange(profiles)*np.timedelta64(interval, 's')
+    tt = t.astype(object)
+    a['year'] = [x.year for x in tt]
+    a['month'] = [x.month for x in tt]
+    a['day'] = [x.day for x in tt]
+    a['hours'] = [x.hour for x in tt]
+    a['minutes'] = [x.minute for x in tt]
+    a['seconds'] = [x.second for x in tt]
+    a['unit'] = 5054
+    a['version'] = 300
+    a['shots_sum'] = 25000
+    a['trigger_frequency'] = 2500
+    a['energy_monitor'] = 7000 + rng.integers(0, 100, profiles)
+    a['number_channels'] = channels
+    a['number_bins'] = bins
+    a['bin_time'] = bin_time
+    a['number_data_bins'] = bins
+    a['header_size'] = mpl_dtype(0).itemsize
+    a['background_average'] = rng.random(profiles)*0.1
+    a['background_average_2'] = rng.random(profiles)*0.1
+    r = np.arange(bins) + 1
+    signal = 1e3/r**1.5
+    a['channel_1'] = signal + rng.random((profiles, bins))*0.1
+    if channels > 1:
+        a['channel_2'] = 2*signal + rng.random((profiles, bins))*0.1
+    a.tofile(filename)
+
+def write_afterpulse(filename, bins=2000, bin_time=2e-7):
+    r = 0.5*bin_time*mpl2nc.C*(np.arange(bins) + 0.5)*1e-3
+    with open(filename, 'wb') as f:
+        np.array([(0xAAEEEEAA, 3, 2, bins, 8.0, 0.01, 0.02)], dtype=[
+            ('header', '<u4'),
+            ('version', '<u2'),
+            ('channels', 'u1'),
+            ('bins', '<u4'),
+            ('energy', '<f8'),
+            ('copol', '<f8'),
+            ('crosspol', '<f8'),
+        ]).tofile(f)
+        r.astype('<f8').tofile(f)
+        (np.exp(-r)*0.5).astype('<f8').tofile(f)
+        (np.exp(-r)*0.3).astype('<f8').tofile(f)
+
+def write_overlap(filename, bins=500):
+    r = np.linspace(0, 15, bins)
+    with open(filename, 'wb') as f:
+        r.astype('<f8').tofile(f)
+        np.clip(r/3, 0.01, 1).astype('<f8').tofile(f)
+
+def write_dead_time(filename, coeff=(1e-9, -2e-6, 1e-4, 1e-3, 1.)):
+    np.array(coeff, '<f4').tofile(filename)
+
+def measure(func):
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    res = func()
+    return res, {
+        'time': time.perf_counter() - t0,
+        'cpu_time': time.process_time() - c0,
+    }
+
+def load_corrections(dirname):
+    corrections = {}
+    for func, name in [
+        (mpl2nc.read_afterpulse, 'ap.bin'),
+        (mpl2nc.read_overlap, 'ol.bin'),
+        (mpl2nc.read_dt, 'dt.bin'),
+    ]:
+        with open(os.path.join(dirname, name), 'rb') as f:
+            corrections.update(func(f))
+    return corrections
+
+def stages(dirname):
+    filename = os.path.join(dirname, 'bench.mpl')
+    output = os.path.join(dirname, 'bench.nc')
+    corrections = load_corrections(dirname)
+    state = {}
+
+    def parse():
+        dd = []
+        with open(filename, 'rb') as f:
+            while True:
+                d = mpl2nc.read_mpl_profile(f)
+                if d is None:
+                    break
+                dd.append(d)
+        state['dd'] = dd
+
+    def process_mpl():
+        mpl2nc.process_mpl(state.pop('dd'))
+
+    def read_mpl():
+        state['d'] = mpl2nc.read_mpl(filename)
+
+    def process_nrb():
+        state['d'].update(corrections)
+        mpl2nc.process_nrb(state['d'])
+
+    def write():
+        mpl2nc.write(state.pop('d'), output)
+
+    return dict(zip(STAGES, [parse, process_mpl, read_mpl, process_nrb,
+        write]))
+
+def reset_peak_rss():
+    # Linux 4.0 or later.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def stage_peak_rss(dirname, stage):
+    # Run only the stage and the stages producing its input in this process.
+    # Where the peak can be reset, it does not include the preceding stages.
+    funcs = stages(dirname)
+    for name in DEPENDS.get(stage, []):
+        funcs[name]()
+    reset_peak_rss()
+    funcs[stage]()
+    return peak_rss()
+
+def run(dirname, profiles, bins, channels, repeat):
+    filename = os.path.join(dirname, 'bench.mpl')
+    write_mpl(filename, profiles, bins, channels)
+    write_afterpulse(os.path.join(dirname, 'ap.bin'), bins)
+    write_overlap(os.path.join(dirname, 'ol.bin'))
+    write_dead_time(os.path.join(dirname, 'dt.bin'))
+    size = os.path.getsize(filename)
+
+    results = {}
+    for i in range(repeat):
+        for stage, func in stages(dirname).items():
+            _, r = measure(func)
+            if stage not in results or r['time'] < results[stage]['time']:
+                results[stage] = r
+    # Peak RSS is the high-water mark of the whole process, so every stage
+    # is run in a new process.
+    for stage in STAGES:
+        results[stage]['peak_rss'] = int(subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--peak-rss', stage,
+            dirname,
+        ]))
+
+    for stage, r in results.items():
+        r['profiles_per_s'] = profiles/r['time']
+        r['mb_per_s'] = size/r['time']/1e6
+    return {
+        'size': size,
+        'output_size': os.path.getsize(os.path.join(dirname, 'bench.nc')),
+        'stages': results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(res, base):
+    print('%-12s %12s %12s %8s' % ('stage', 'base (s)', 'new (s)', 'ratio'))
+    for stage in STAGES:
+        if stage not in base['stages'] or stage not in res['stages']:
+            continue
+        t0 = base['stages'][stage]['time']
+        t1 = res['stages'][stage]['time']
+        print('%-12s %12.4f %12.4f %8.2f' % (stage, t0, t1, t1/t0))
+
+def main():
+    p = argparse.ArgumentParser(prog='bench.py',
+        description='Benchmark mpl2nc on synthetic MPL files.'
+    )
+    p.add_argument('-p', '--profiles', type=int, default=1000,
+        help='number of profiles (default: 1000)')
+    p.add_argument('-b', '--bins', type=int, default=2000,
+        help='number of bins (default: 2000)')
+    p.add_argument('-c', '--channels', type=int, default=2, choices=[1, 2],
+        help='number of channels (default: 2)')
+    p.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of repetitions; the fastest is reported (default: 3)')
+    p.add_argument('-o', '--output', help='write results to a JSON file')
+    p.add_argument('--compare', help='compare with results in a JSON file')
+    p.add_argument('--peak-rss', nargs=2, metavar=('STAGE', 'DIR'),
+        help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.peak_rss is not None:
+        print(stage_peak_rss(args.peak_rss[1], args.peak_rss[0]))
+        return
+
+    with tempfile.TemporaryDirectory() as dirname:
+        res = run(dirname, args.profiles, args.bins, args.channels,
+            args.repeat)
+    res.update({
+        'created': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': git_commit(),
+        'version': mpl2nc.__version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'profiles': args.profiles,
+        'bins': args.bins,
+        'channels': args.channels,
+    })
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=1, sort_keys=True)
+
+    print('%-12s %10s %10s %12s %10s %12s' % (
+        'stage', 'time (s)', 'cpu (s)', 'profiles/s', 'MB/s', 'peak RSS (MB)'))
+    for stage in STAGES:
+        r = res['stages'][stage]
+        print('%-12s %10.4f %10.4f %12.0f %10.1f %12.1f' % (
+            stage, r['time'], r['cpu_time'], r['profiles_per_s'], r['mb_per_s'],
+            r['peak_rss']/1e6))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print()
+        compare(res, base)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import datetime as dt
+
+import numpy as np
+
+from bench import write_mpl, write_afterpulse, write_overlap, \
+    write_dead_time, git_commit
+
+MPL2NC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'mpl2nc.py')
+
+CASES = ['import', 'version', 'help', 'corrections', 'convert']
+
+def commands(dirname):
+    ap = os.path.join(dirname, 'ap.bin')
+    ol = os.path.join(dirname, 'ol.bin')
+    dt_ = os.path.join(dirname, 'dt.bin')
+    return {
+        'import': [sys.executable, '-c', 'import mpl2nc'],
+        'version': [sys.executable, MPL2NC, '-v'],
+        'help': [sys.executable, MPL2NC, '--help'],
+        'corrections': [sys.executable, MPL2NC, '-a', ap, '-o', ol,
+            '-d', dt_, os.path.join(dirname, 'calibration.nc')],
+        'convert': [sys.executable, MPL2NC, '-a', ap, '-o', ol,
+            '-d', dt_, os.path.join(dirname, 'startup.mpl'),
+            os.path.join(dirname, 'startup.nc')],
+    }
+
+def run(dirname, repeat):
+    write_mpl(os.path.join(dirname, 'startup.mpl'), profiles=10, bins=200)
+    write_afterpulse(os.path.join(dirname, 'ap.bin'), bins=200)
+    write_overlap(os.path.join(dirname, 'ol.bin'))
+    write_dead_time(os.path.join(dirname, 'dt.bin'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(MPL2NC) + \
+        (os.pathsep + env['PYTHONPATH'] if 'PYTHONPATH' in env else '')
+    # Keep the correction cache (if supported by the version) out of the
+    # user's cache directory.
+    env['MPL2NC_CACHE'] = os.path.join(dirname, 'cache')
+    results = {}
+    for case, cmd in commands(dirname).items():
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            subprocess.run(cmd, env=env, check=True,
+                stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - t0)
+        results[case] = {
+            'min': min(times),
+            'median': float(np.median(times)),
+        }
+    return {'cases': results}
+
+def compare(res, base):
+    print('%-12s %12s %12s %8s' % ('case', 'base (s)', 'new (s)', 'ratio'))
+    for case in CASES:
+        if case not in base['cases'] or case not in res['cases']:
+            continue
+        t0 = base['cases'][case]['min']
+        t1 = res['cases'][case]['min']
+        print('%-12s %12.4f %12.4f %8.2f' % (case, t0, t1, t1/t0))
+
+def main():
+    p = argparse.ArgumentParser(prog='startup.py',
+        description='Benchmark the startup time of common mpl2nc commands.'
+    )
+    p.add_argument('-r', '--repeat', type=int, default=10,
+        help='number of repetitions (default: 10)')
+    p.add_argument('-o', '--output', help='write results to a JSON file')
+    p.add_argument('--compare', help='compare with results in a JSON file')
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        res = run(dirname, args.repeat)
+    res.update({
+        'created': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    })
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=1, sort_keys=True)
+
+    print('%-12s %10s %10s' % ('case', 'min (s)', 'median (s)'))
+    for case in CASES:
+        r = res['cases'][case]
+        print('%-12s %10.4f %10.4f' % (case, r['min'], r['median']))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print()
+        compare(res, base)
+
+if __name__ == '__main__':
+    main()
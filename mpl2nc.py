@@ -9,10 +9,17 @@ import argparse
 import warnings
 import struct
 import datetime as dt
+import time as tm
+import traceback
+import json
+import contextlib
+import glob
+import hashlib
+import io
+import collections
+import threading
 
 import numpy as np
-from netCDF4 import Dataset
-import ds_format as ds
 
 __version__ = '1.4.2'
 
@@ -130,6 +137,30 @@ HEADER_AFTERPULSE = [
     ['ap_background_average_crosspol', 'float64', 'afterpulse cross pol background average', 'count us-1'],
 ]
 
+MANIFEST = '.mpl2nc.json'
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'MPL2NCI1'
+INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'),
+    ('time', '<i8'),
+    ('number_bins', '<u4'),
+])
+
+CHUNK_PROFILES = 128
+CHUNK_PROFILES_1D = 4096
+CHUNK_SIZE = 1000
+
+# Dead time correction polynomial lookup tables cover 0 to DTCF_MAX_COUNT
+# count us-1 and are refined until the error relative to the exact calculation
+# is at most DTCF_TOLERANCE*max(1, |dtcf|) at the cell midpoints. Values
+# outside of the table are calculated exactly.
+DTCF_TOLERANCE = 1e-4
+DTCF_MAX_COUNT = 50
+DTCF_TABLE_MIN_COEFF = 6
+DTCF_TABLE_MAX_SIZE = 2**22
+DTCF_CACHE_SIZE = 8
+
 HEADER_TYPES = {x[0]: x[1] for x in HEADER_MPL}
 HEADER_TYPES['channel_1'] = 'float32'
 HEADER_TYPES['channel_2'] = 'float32'
@@ -145,6 +176,35 @@ EXCL_FIELDS = [
     'number_bins',
 ]
 
+NRB_FIELDS = ['nrb_copol', 'nrb_crosspol']
+
+# Profile fields averaged over time bins weighted by the number of shots.
+# Other fields are summed (shots_sum), root mean squared (standard
+# deviations), maximised (flags) or taken from the first profile of the bin.
+AVERAGE_FIELDS = [
+    'channel_1',
+    'channel_2',
+    'energy_monitor',
+    'temp_0',
+    'temp_1',
+    'temp_2',
+    'temp_3',
+    'temp_4',
+    'background_average',
+    'background_average_2',
+    'sync_pulses_seen_per_second',
+    'ws_inside_temp',
+    'ws_outside_temp',
+    'ws_inside_humidity',
+    'ws_outside_humidity',
+    'ws_dewpoint',
+    'ws_wind_speed',
+    'ws_barometric_pressure',
+    'ws_rain_rate',
+]
+AVERAGE_RMS_FIELDS = ['background_stddev', 'background_stddev_2']
+AVERAGE_MAX_FIELDS = ['ad_data_bad_flag']
+
 HEADER_FIELDS = [x[0] for x in HEADER_MPL]
 FIELDS = [x for x in HEADER_FIELDS if x not in EXCL_FIELDS]
 
@@ -201,8 +261,7 @@ def read_afterpulse(f):
         buf = f.read(8*n)
         if len(buf) < 8*n:
             raise IOError('incomplete %s data' % x)
-        a = struct.unpack_from('<' + 'd'*n, buf)
-        d[x] = np.array(a, np.float64)
+        d[x] = np.frombuffer(buf, '<f8').astype(np.float64)
     return d
 
 def read_overlap(f):
@@ -214,21 +273,21 @@ def read_overlap(f):
         buf = f.read(8*n)
         if len(buf) < 8*n:
             raise IOError('incomplete %s data' % x)
-        a = struct.unpack_from('<' + 'd'*n, buf)
-        d[x] = np.array(a, np.float64)
+        d[x] = np.frombuffer(buf, '<f8').astype(np.float64)
     return d
 
 def read_dt(f):
     buf = f.read()
     n = len(buf)//4
-    a = struct.unpack_from('<' + 'f'*n, buf)
+    a = np.frombuffer(buf, '<f4', n)
     return {
         'dt_number_coeff': np.array(n, np.uint32),
-        'dt_coeff': np.array(a),
+        'dt_coeff': a.astype(np.float64),
         'dt_coeff_degree': np.arange(n - 1, -1, -1, dtype=np.uint32),
     }
 
 def read_dt_csv(filename):
+    import ds_format as ds
     d = ds.read(filename)
     if 'count' not in d or 'factor' not in d or \
         d['count'].dtype != np.float64 or d['factor'].dtype != np.float64:
@@ -238,6 +297,53 @@ def read_dt_csv(filename):
         'dt_count': d['count']*1e3,
     }
 
+def cache_dir():
+    if 'MPL2NC_CACHE' in os.environ:
+        return os.environ['MPL2NC_CACHE']
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'mpl2nc'
+    )
+
+def read_correction(filename, type_, cache=True):
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    if cache:
+        st = os.stat(filename)
+        h = hashlib.sha1(('%s\0%s\0%s\0%d\0%d\0' % (
+            __version__,
+            type_,
+            os.path.abspath(filename),
+            st.st_size,
+            st.st_mtime_ns,
+        )).encode('utf-8'))
+        h.update(hashlib.sha1(buf).digest())
+        cache_filename = os.path.join(cache_dir(), h.hexdigest() + '.npz')
+        try:
+            with np.load(cache_filename) as z:
+                return {k: z[k] for k in z.files}
+        except Exception:
+            pass
+    if type_ == 'afterpulse':
+        d = read_afterpulse(io.BytesIO(buf))
+    elif type_ == 'overlap':
+        d = read_overlap(io.BytesIO(buf))
+    elif type_ == 'dead_time':
+        d = read_dt(io.BytesIO(buf))
+    elif type_ == 'dead_time_csv':
+        d = read_dt_csv(filename)
+    else:
+        raise ValueError('invalid correction type "%s"' % type_)
+    if cache:
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            tmp_filename = '%s.%d.tmp.npz' % (cache_filename, os.getpid())
+            np.savez(tmp_filename, **d)
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            pass
+    return d
+
 def read_mpl_profile(f):
     d = read_header(f, HEADER_MPL)
     if d is None:
@@ -251,6 +357,99 @@ def read_mpl_profile(f):
         d[x] = np.array(a, dtype=np.float32)
     return d
 
+def mpl_dtype(number_bins):
+    return np.dtype(
+        [(x[0], '<' + NC_TYPE[x[1]]) for x in HEADER_MPL] +
+        [(x, '<f4', (number_bins,)) for x in ['channel_1', 'channel_2']]
+    )
+
+def read_mpl_records(f):
+    d = read_header(f, HEADER_MPL)
+    if d is None:
+        return None
+    n = int(d['number_bins'])
+    dtype = mpl_dtype(n)
+    size = os.fstat(f.fileno()).st_size
+    if size % dtype.itemsize != 0:
+        return None
+    f.seek(0)
+    a = np.fromfile(f, dtype)
+    if np.any(a['number_bins'] != n):
+        return None
+    return a
+
+def prefix_dtype(dtype, max_bins):
+    channel = np.dtype(('<f4', (max_bins,)))
+    return np.dtype({
+        'names': dtype.names,
+        'formats': [channel if x in ('channel_1', 'channel_2') else
+            dtype.fields[x][0] for x in dtype.names],
+        'offsets': [dtype.fields[x][1] for x in dtype.names],
+        'itemsize': dtype.itemsize,
+    })
+
+def bin_limit(number_bins, bin_time, max_bins=None, max_range=None):
+    m = number_bins
+    if max_bins is not None:
+        m = min(m, max_bins)
+    bin_time = np.asarray(bin_time, np.float64)
+    if max_range is not None and bin_time.size > 0 and np.min(bin_time) > 0:
+        # Number of bins whose centre is at most max_range (km).
+        m = min(m, max(0, int(np.floor(
+            max_range*1e3/(0.5*np.min(bin_time)*C) + 0.5
+        ))))
+    if m == 0 and number_bins > 0:
+        raise ValueError('no range bins selected (maximum range is below the first range bin)')
+    return m
+
+def in_window(t, start=None, end=None):
+    mask = np.ones(np.shape(t), bool)
+    if start is not None:
+        mask &= t >= start
+    if end is not None:
+        mask &= t < end
+    return mask
+
+def select_records(a, start=None, end=None, max_bins=None, max_range=None):
+    if start is None and end is None and max_bins is None and \
+        max_range is None:
+        return a
+    if start is not None or end is not None:
+        i = np.flatnonzero(in_window(time64(a), start, end))
+    else:
+        i = np.arange(len(a))
+    n = a.dtype['channel_1'].shape[0]
+    m = bin_limit(n, a['bin_time'][i], max_bins, max_range)
+    # Only the header and the first m bins of each channel of the selected
+    # profiles are copied. With a memory-mapped file, the rest is never read.
+    v = a.view(prefix_dtype(a.dtype, m))
+    res = np.empty(len(i), mpl_dtype(m))
+    for k in res.dtype.names:
+        res[k] = v[k][i]
+    return res
+
+def read_mpl_window(f, start=None, end=None, max_bins=None, max_range=None):
+    size = os.fstat(f.fileno()).st_size
+    dd = []
+    while True:
+        d = read_header(f, HEADER_MPL)
+        if d is None:
+            break
+        n = int(d['number_bins'])
+        offset = f.tell()
+        if offset + 8*n > size:
+            raise IOError('incomplete profile data')
+        if in_window(time64(d), start, end):
+            m = bin_limit(n, d['bin_time'], max_bins, max_range)
+            for i, x in enumerate(['channel_1', 'channel_2']):
+                f.seek(offset + 4*n*i)
+                d[x] = np.frombuffer(f.read(4*m), '<f4').astype(np.float32)
+            dd.append(d)
+        f.seek(offset + 8*n)
+    if len(dd) == 0:
+        return process_mpl_records(np.zeros(0, mpl_dtype(0)))
+    return process_mpl(dd)
+
 def time_utc(d):
     return '%04d-%02d-%02dT%02d:%02d:%02d' % (
         d['year'],
@@ -267,60 +466,177 @@ def time(d):
     t0 = dt.datetime(1970, 1, 1)
     return (t - t0).total_seconds()
 
+def time64(d):
+    year = np.asarray(d['year'], np.int64)
+    month = np.asarray(d['month'], np.int64)
+    day = np.asarray(d['day'], np.int64)
+    hours = np.asarray(d['hours'], np.int64)
+    minutes = np.asarray(d['minutes'], np.int64)
+    seconds = np.asarray(d['seconds'], np.int64)
+    m = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + \
+        (month - 1).astype('timedelta64[M]')
+    t = m.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    if np.any((month < 1) | (month > 12) | (day < 1) | \
+        (t.astype('datetime64[M]') != m) | \
+        (hours > 23) | (minutes > 59) | (seconds > 59)):
+        raise ValueError('invalid profile time')
+    return t.astype('datetime64[s]') + \
+        (hours*3600 + minutes*60 + seconds).astype('timedelta64[s]')
+
 def calc_dtcf_from_coeff(x, coeff):
     n = len(coeff)
-    with warnings.catch_warnings():
-        warnings.filterwarnings('error')
+    # np.errstate applies only to the current thread, unlike
+    # warnings.catch_warnings, so warnings in other threads are not affected.
+    with np.errstate(divide='raise', over='raise', invalid='raise'):
         try:
             return np.sum([(x*1e3)**(n-i-1)*coeff[i] for i in range(n)], axis=0)
-        except RuntimeWarning as e:
+        except FloatingPointError as e:
             raise ValueError('overflow encountered in dead time correction calculation - please supply dead time correction polynomial curve from the instrument\'s documentation as a CSV file (see README for instructions)')
 
 def calc_dtcf_from_count_factor(x, count, factor):
-    logcount = np.log(count)
+    warnings.warn('calc_dtcf_from_count_factor is deprecated, use DeadTimeCorrection instead', DeprecationWarning)
     logfactor = np.log(factor)
     if type(x) is not np.ndarray or x.ndim == 0:
         x = np.array([x])
-    dtcf = np.ones(len(x), np.float64)
+    dtcf = np.ones(x.shape, np.float64)
     mask = x*1e3 <= count[-1]
     if not np.all(mask):
         warnings.warn('input data contain values outside of the supplied dead time correction polynomial curve')
     dtcf[mask] = np.exp(np.interp(x[mask]*1e3, count, logfactor, left=0, right=np.inf))
     return dtcf
 
-def calc_nrb(d, channel, name, name2):
+class DeadTimeCorrection:
+    def __init__(self, coeff=None, count=None, factor=None,
+        tolerance=DTCF_TOLERANCE, max_count=DTCF_MAX_COUNT):
+        self.coeff = coeff
+        self.count = count
+        self.table = None
+        if coeff is not None:
+            self.coeff64 = np.asarray(coeff, np.float64)
+            self.end = float(max_count)
+            # Horner evaluation is faster than a table lookup for polynomials
+            # of low degree.
+            if len(coeff) > DTCF_TABLE_MIN_COEFF:
+                self._build_table(tolerance)
+        elif count is not None and factor is not None:
+            # A count/factor curve is evaluated directly with np.interp,
+            # which is as fast as a table lookup for curves of this size.
+            self.logfactor = np.log(factor)
+        else:
+            raise ValueError('dead time coefficients or count and factor have to be specified')
+
+    def _build_table(self, tolerance):
+        n = 1024
+        while n <= DTCF_TABLE_MAX_SIZE:
+            grid = np.linspace(0, self.end, n)
+            values = self.exact(grid)
+            self.scale = (n - 1)/self.end
+            # Value and slope of each cell packed in one complex number, so
+            # that the lookup is a single gather.
+            self.table = values[:-1] + 1j*np.diff(values)
+            x = 0.5*(grid[1:] + grid[:-1])
+            y = self.exact(x)
+            err = np.abs(self._interp(x) - y)/np.maximum(1, np.abs(y))
+            if np.max(err) <= tolerance:
+                return
+            n *= 2
+        self.table = None
+
+    def _interp(self, x):
+        n = len(self.table)
+        u = np.array(x, np.float64)
+        u *= self.scale
+        np.fmax(u, 0, out=u)
+        np.fmin(u, n, out=u)
+        i = np.minimum(u.astype(np.intp), n - 1)
+        u -= i
+        t = np.take(self.table, i)
+        u *= t.imag
+        u += t.real
+        return u
+
+    def exact(self, x):
+        x = np.asarray(x, np.float64)*1e3
+        y = np.zeros(x.shape, np.float64)
+        for c in self.coeff64:
+            y = y*x + c
+        return y
+
+    def __call__(self, x):
+        x = np.asarray(x)
+        if self.coeff is None:
+            x1 = x*1e3
+            mask = x1 <= self.count[-1]
+            if not np.all(mask):
+                warnings.warn('input data contain values outside of the supplied dead time correction polynomial curve')
+            y = np.exp(np.interp(x1, self.count, self.logfactor, left=0,
+                right=0))
+            return np.where(mask, y, 1.) if not np.all(mask) else y
+        if self.table is None:
+            # Powers of float32 input are calculated in float32 as in
+            # previous versions, so that the result does not change.
+            return calc_dtcf_from_coeff(x, self.coeff)
+        if x.size > 0:
+            # Raises the same overflow error as calc_dtcf_from_coeff.
+            calc_dtcf_from_coeff(np.max(np.abs(x)), self.coeff)
+        y = self._interp(x)
+        mask = (x >= 0) & (x <= self.end)
+        return np.where(mask, y, self.exact(x)) if not np.all(mask) else y
+
+DTCF_CACHE = []
+
+def dtcf_func(d):
+    if 'dt_coeff' in d:
+        arrays = (d['dt_coeff'],)
+    elif 'dt_count' in d and 'dt_factor' in d:
+        arrays = (d['dt_count'], d['dt_factor'])
+    else:
+        return lambda x: 1
+    # Reuse the table when the same correction arrays are used for multiple
+    # files.
+    for arrays2, dtcf in DTCF_CACHE:
+        if len(arrays2) == len(arrays) and \
+            all(a is b for a, b in zip(arrays, arrays2)):
+            return dtcf
+    if len(arrays) == 1:
+        dtcf = DeadTimeCorrection(coeff=arrays[0])
+    else:
+        dtcf = DeadTimeCorrection(count=arrays[0], factor=arrays[1])
+    DTCF_CACHE[:] = [(arrays, dtcf)] + DTCF_CACHE[:(DTCF_CACHE_SIZE - 1)]
+    return dtcf
+
+def calc_nrb(d, channel, name, name2, dtcf=None):
     raw = d[channel]
     n, m = raw.shape
     background = d['background_average' + name2]
     ap = d.get('ap' + name, np.zeros(m, np.float64))
-    energy = d['energy_monitor']*1e-3
+    energy = (d['energy_monitor']*1e-3)[:,np.newaxis]
     ap_energy = d.get('ap_energy', 1.)
     ap_background = d.get('ap_background_average' + name, 0.)
     ol_range = d.get('ol_range')
     ap_range = d.get('ap_range')
     overlap = d.get('ol_overlap', np.ones(m, np.float64))
 
-    nrb = np.full((n, m), np.nan, np.float64)
-
-    if 'dt_coeff' in d:
-        calc_dtcf = lambda x: calc_dtcf_from_coeff(x, d['dt_coeff'])
-    elif 'dt_count' in d and 'dt_factor' in d:
-        calc_dtcf = lambda x: \
-            calc_dtcf_from_count_factor(x, d['dt_count'], d['dt_factor'])
-    else:
-        calc_dtcf = lambda x: 1
+    calc_dtcf = dtcf if dtcf is not None else dtcf_func(d)
 
-    for i in range(n):
-        range_ = 0.5*d['bin_time'][i]*C*(np.arange(m) + 0.5)*1e-3
-        ap2 = np.interp(range_, ap_range, ap) if ap_range is not None else ap
-        overlap2 = np.interp(range_, ol_range, overlap) if ol_range is not None else overlap
-        nrb[i] = (raw[i,:]*calc_dtcf(raw[i,:]) - \
-            background[i]*calc_dtcf(background[i]) - \
-            ap2*calc_dtcf(ap2)*energy[i]/ap_energy + \
-            ap_background*calc_dtcf(ap_background)*energy[i]/ap_energy)* \
-            range_**2/(overlap2*energy[i])
+    # Range, afterpulse and overlap only depend on bin time, which is
+    # constant in most files.
+    bin_time, k = np.unique(d['bin_time'], return_inverse=True)
+    range_ = (0.5*bin_time*C)[:,np.newaxis]*(np.arange(m) + 0.5)*1e-3
+    ap2 = np.array([
+        np.interp(r, ap_range, ap) if ap_range is not None else ap
+        for r in range_
+    ]).reshape(range_.shape)
+    overlap2 = np.array([
+        np.interp(r, ol_range, overlap) if ol_range is not None else overlap
+        for r in range_
+    ]).reshape(range_.shape)
 
-    return nrb
+    return (raw*calc_dtcf(raw) - \
+        (background*calc_dtcf(background))[:,np.newaxis] - \
+        (ap2*calc_dtcf(ap2))[k]*energy/ap_energy + \
+        ap_background*calc_dtcf(ap_background)*energy/ap_energy)* \
+        (range_**2)[k]/(overlap2[k]*energy)
 
 def process_mpl(dd):
     dx = {}
@@ -337,14 +653,152 @@ def process_mpl(dd):
     dx['c'] = C
     return dx
 
-def process_nrb(d):
-    d['nrb_copol'] = calc_nrb(d, 'channel_2', '_copol', '_2')
-    d['nrb_crosspol'] = calc_nrb(d, 'channel_1', '_crosspol', '')
+def process_mpl_records(a):
+    dx = {}
+    for k in FIELDS:
+        dx[k] = a[k].astype(HEADER_TYPES[k], copy=False)
+    dx['channel_1'] = a['channel_1']
+    dx['channel_2'] = a['channel_2']
+    t = time64(a)
+    dx['time_utc'] = np.datetime_as_string(t, unit='s').astype('U19')
+    dx['time'] = (t - np.datetime64(0, 's')).astype(np.uint64)
+    dx['c'] = C
+    return dx
+
+def cast(x, dtype):
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        x = np.clip(np.round(x), info.min, info.max)
+    return x.astype(dtype)
+
+def average(d, interval=None, range_factor=1):
+    d = dict(d)
+    n = len(d['time'])
+    if interval is not None and n > 0:
+        d = select_profiles(d, np.argsort(d['time'], kind='stable'))
+        k = d['time'].astype(np.int64)//interval
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(k)) + 1])
+        counts = np.diff(np.append(starts, n))
+        w = d['shots_sum'].astype(np.float64)
+        wsum = np.add.reduceat(w, starts)
+        # Profiles in time bins without shots are weighted equally.
+        if np.any(wsum == 0):
+            w = np.where(np.repeat(wsum == 0, counts), 1., w)
+            wsum = np.add.reduceat(w, starts)
+        def mean(x):
+            shape = (-1,) + (1,)*(x.ndim - 1)
+            return np.add.reduceat(x*w.reshape(shape), starts, axis=0)/ \
+                wsum.reshape(shape)
+        for key, v in d.items():
+            if 'profile' not in NC_HEADER[key]['dims']:
+                continue
+            if key in AVERAGE_FIELDS:
+                y = mean(np.asarray(v, np.float64))
+            elif key in AVERAGE_RMS_FIELDS:
+                y = np.sqrt(mean(np.asarray(v, np.float64)**2))
+            elif key in AVERAGE_MAX_FIELDS:
+                y = np.maximum.reduceat(v, starts)
+            elif key == 'shots_sum':
+                y = np.add.reduceat(v.astype(np.uint64), starts)
+            else:
+                y = v[starts]
+            d[key] = cast(y, v.dtype)
+        t = (k[starts]*interval).astype('datetime64[s]')
+        d['time_utc'] = np.datetime_as_string(t, unit='s').astype('U19')
+        d['time'] = (t - np.datetime64(0, 's')).astype(np.uint64)
+    if range_factor > 1:
+        n = d['channel_1'].shape[1]
+        m = n//range_factor
+        if m == 0 and n > 0:
+            raise ValueError('number of range bins to average (%d) is larger than the number of range bins (%d)' % (range_factor, n))
+        for key in ['channel_1', 'channel_2']:
+            v = d[key][:,:(m*range_factor)]
+            d[key] = v.reshape(v.shape[0], m, range_factor).mean(axis=2,
+                dtype=np.float64).astype(np.float32)
+        d['bin_time'] = (d['bin_time']*range_factor).astype(np.float32)
     return d
 
-def read_mpl(filename):
+def split_last_bin(d, interval):
+    k = d['time'].astype(np.int64)//interval
+    mask = k == np.max(k)
+    return select_profiles(d, ~mask), select_profiles(d, mask)
+
+def concat_profiles(d1, d2):
+    return {k: np.concatenate([d1[k], v]) if 'profile' in NC_HEADER[k]['dims']
+        else v for k, v in d2.items()}
+
+def process_nrb(d, dtcf=None):
+    if dtcf is None:
+        dtcf = dtcf_func(d)
+    d['nrb_copol'] = calc_nrb(d, 'channel_2', '_copol', '_2', dtcf)
+    d['nrb_crosspol'] = calc_nrb(d, 'channel_1', '_crosspol', '', dtcf)
+    return d
+
+class MPLFile:
+    def __init__(self, filename, records=None):
+        self.filename = filename
+        if records is None:
+            records = self._index()
+        self.records = records
+
+    def _index(self):
+        with open(self.filename, 'rb') as f:
+            d = read_header(f, HEADER_MPL)
+            size = os.fstat(f.fileno()).st_size
+        if d is None:
+            return np.zeros(0, mpl_dtype(0))
+        n = int(d['number_bins'])
+        dtype = mpl_dtype(n)
+        if size % dtype.itemsize != 0:
+            raise IOError('incomplete profile data or variable number of bins')
+        records = np.memmap(self.filename, dtype, mode='r')
+        if np.any(records['number_bins'] != n):
+            raise IOError('variable number of bins is not supported')
+        return records
+
+    @property
+    def offsets(self):
+        return np.arange(len(self.records), dtype=np.int64)* \
+            self.records.dtype.itemsize
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.records[key]
+        if not isinstance(key, slice):
+            n = len(self)
+            i = key + n if key < 0 else key
+            if i < 0 or i >= n:
+                raise IndexError('profile index out of range')
+            key = slice(i, i + 1)
+        return MPLFile(self.filename, self.records[key])
+
+    def read(self, start=None, end=None, max_bins=None, max_range=None):
+        return process_mpl_records(select_records(self.records, start, end,
+            max_bins, max_range))
+
+def read_mpl(filename, mmap=False, start=None, end=None, max_bins=None,
+    max_range=None):
+    subset = (start, end, max_bins, max_range)
+    if isinstance(filename, MPLFile):
+        return filename.read(*subset)
+    if mmap:
+        return MPLFile(filename).read(*subset)
+    if any(x is not None for x in subset):
+        try:
+            mpl_file = MPLFile(filename)
+        except IOError:
+            with open(filename, 'rb') as f:
+                return read_mpl_window(f, *subset)
+        return mpl_file.read(*subset)
     dd = []
     with open(filename, 'rb') as f:
+        a = read_mpl_records(f)
+        if a is not None:
+            return process_mpl_records(a)
+        f.seek(0)
         while True:
             d = read_mpl_profile(f)
             if d is None:
@@ -352,7 +806,131 @@ def read_mpl(filename):
             dd.append(d)
     return process_mpl(dd)
 
-def write(d, filename):
+def read_mpl_chunks(filename, chunk_size, start=None, end=None,
+    max_bins=None, max_range=None):
+    with open(filename, 'rb') as f:
+        while True:
+            offset = f.tell()
+            d = read_header(f, HEADER_MPL)
+            if d is None:
+                break
+            n = int(d['number_bins'])
+            dtype = mpl_dtype(n)
+            f.seek(offset)
+            a = np.fromfile(f, dtype, count=chunk_size)
+            if len(a) == 0:
+                # Raise the same error as when reading the whole file.
+                f.seek(offset)
+                read_mpl_profile(f)
+                raise IOError('incomplete profile data')
+            i = np.flatnonzero(a['number_bins'] != n)
+            if len(i) > 0:
+                a = a[:i[0]]
+            # np.fromfile skips an incomplete record at the end of the file.
+            f.seek(offset + len(a)*dtype.itemsize)
+            a = select_records(a, start, end, max_bins, max_range)
+            if len(a) > 0:
+                yield process_mpl_records(a)
+
+def read_mpl_tail(filename, offset=0):
+    dd = []
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < offset:
+            raise IOError('input file is shorter than the already converted part')
+        f.seek(offset)
+        while True:
+            try:
+                d = read_mpl_profile(f)
+            except IOError:
+                break
+            if d is None:
+                break
+            dd.append(d)
+            offset = f.tell()
+    return dd, offset
+
+def build_index(filename):
+    try:
+        mpl_file = MPLFile(filename)
+    except IOError:
+        mpl_file = None
+    if mpl_file is not None:
+        index = np.empty(len(mpl_file), INDEX_DTYPE)
+        index['offset'] = mpl_file.offsets
+        index['time'] = time64(mpl_file.records).astype(np.int64)
+        index['number_bins'] = mpl_file['number_bins']
+        return index
+    rows = []
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            offset = f.tell()
+            d = read_header(f, HEADER_MPL)
+            if d is None:
+                break
+            n = int(d['number_bins'])
+            if f.tell() + 8*n > size:
+                break
+            rows.append((offset, time64(d).astype(np.int64), n))
+            f.seek(8*n, 1)
+    return np.array(rows, INDEX_DTYPE)
+
+def read_index(filename, cache=True):
+    st = os.stat(filename)
+    header = struct.Struct('<8sqq')
+    index_filename = filename + INDEX_SUFFIX
+    if cache:
+        try:
+            with open(index_filename, 'rb') as f:
+                buf = f.read()
+            if header.unpack_from(buf) == \
+                (INDEX_MAGIC, st.st_size, st.st_mtime_ns):
+                return np.frombuffer(buf, INDEX_DTYPE, offset=header.size)
+        except (OSError, struct.error, ValueError):
+            pass
+    index = build_index(filename)
+    if cache:
+        try:
+            tmp_filename = '%s.%d.tmp' % (index_filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                f.write(header.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns))
+                f.write(index.tobytes())
+            os.replace(tmp_filename, index_filename)
+        except OSError:
+            pass
+    return index
+
+def read_mpl_index(filename, key=None, start=None, end=None, index=None):
+    if index is None:
+        index = read_index(filename)
+    i = np.arange(len(index))
+    if key is not None:
+        i = np.atleast_1d(i[key])
+    if start is not None or end is not None:
+        t = index['time'][i].astype('datetime64[s]')
+        i = i[in_window(t, start, end)]
+    if len(i) == 0:
+        return process_mpl_records(np.zeros(0, mpl_dtype(0)))
+    n = np.unique(index['number_bins'][i])
+    if len(n) > 1:
+        raise IOError('variable number of bins is not supported')
+    dtype = mpl_dtype(int(n[0]))
+    offset = index['offset'][i]
+    # Consecutive profiles are read at once.
+    runs = np.flatnonzero(np.diff(offset) != dtype.itemsize) + 1
+    with open(filename, 'rb') as f:
+        aa = []
+        for j in np.split(np.arange(len(i)), runs):
+            f.seek(offset[j[0]])
+            a = np.fromfile(f, dtype, count=len(j))
+            if len(a) < len(j):
+                raise IOError('incomplete profile data')
+            aa.append(a)
+    return process_mpl_records(np.concatenate(aa))
+
+def write(d, filename, attrs=None, compression='zlib', complevel=4,
+    shuffle=True, chunksizes=None, nrb_dtype='float64', var_options=None):
+    from netCDF4 import Dataset
     f = Dataset(filename, 'w')
     f.createDimension('profile', None)
     f.createDimension('range', None)
@@ -364,8 +942,27 @@ def write(d, filename):
         f.createDimension('dt_count', None)
     for k, v in d.items():
         h = NC_HEADER[k]
-        var = f.createVariable(k, NC_TYPE[h['dtype']], h['dims'],
-            fill_value=FILL_VALUE[h['dtype']])
+        dtype = nrb_dtype if k in NRB_FIELDS else h['dtype']
+        opts = {}
+        if len(h['dims']) > 0 and compression is not None:
+            if compression == 'zlib':
+                opts['zlib'] = True
+            else:
+                opts['compression'] = compression
+            opts['complevel'] = complevel
+            opts['shuffle'] = shuffle
+        if h['dims'] == ['profile', 'range']:
+            opts['chunksizes'] = chunksizes if chunksizes is not None else \
+                (CHUNK_PROFILES, max(1, v.shape[1]))
+        elif h['dims'] == ['profile']:
+            # Otherwise the chunk size is the number of profiles written
+            # first, which can be as small as one with --append.
+            opts['chunksizes'] = (max(CHUNK_PROFILES_1D,
+                chunksizes[0] if chunksizes is not None else 0),)
+        if var_options is not None:
+            opts.update(var_options.get(k, {}))
+        var = f.createVariable(k, NC_TYPE[dtype], h['dims'],
+            fill_value=FILL_VALUE[dtype], **opts)
         var[::] = v
         if h['units'] is not None: var.units = h['units']
         if h['long_name'] is not None: var.long_name = h['long_name']
@@ -373,10 +970,807 @@ def write(d, filename):
     f.created = dt.datetime.utcnow().strftime('%Y-%m-%dT:%H:%M:%SZ')
     f.software = 'mpl2nc (https://github.com/peterkuma/mpl2nc)'
     f.version = __version__
+    if attrs is not None:
+        f.setncatts(attrs)
     f.close()
 
+def append(d, filename, attrs=None):
+    from netCDF4 import Dataset
+    f = Dataset(filename, 'a')
+    n = len(f.dimensions['profile'])
+    for k, v in d.items():
+        if 'profile' not in NC_HEADER[k]['dims']:
+            continue
+        var = f.variables[k]
+        if np.ndim(v) == 2:
+            var[n:(n + v.shape[0]),:v.shape[1]] = v
+        else:
+            var[n:(n + len(v))] = v
+    if attrs is not None:
+        f.setncatts(attrs)
+    f.close()
+
+def global_attrs(attrs=None):
+    res = {
+        'created': dt.datetime.utcnow().strftime('%Y-%m-%dT:%H:%M:%SZ'),
+        'software': 'mpl2nc (https://github.com/peterkuma/mpl2nc)',
+        'version': __version__,
+    }
+    if attrs is not None:
+        res.update({k: v.item() if isinstance(v, np.generic) else v
+            for k, v in attrs.items()})
+    return res
+
+def var_attrs(k):
+    h = NC_HEADER[k]
+    return {x: h[x] for x in ['long_name', 'units', 'comment']
+        if h[x] is not None}
+
+def write_zarr(d, filename, attrs=None, compression='zlib', complevel=4,
+    shuffle=True, chunksizes=None, nrb_dtype='float64', var_options=None):
+    try:
+        import zarr
+        from zarr.codecs import BloscCodec
+    except ImportError:
+        raise ImportError('the zarr format requires the zarr package (install mpl2nc[zarr])')
+    g = zarr.open_group(filename, mode='w')
+    for k, v in d.items():
+        h = NC_HEADER[k]
+        dtype = nrb_dtype if k in NRB_FIELDS else h['dtype']
+        v = np.asarray(v)
+        opts = {}
+        if compression is not None:
+            # Blosc compresses with multiple threads, and zarr writes chunks
+            # concurrently.
+            opts['compressors'] = BloscCodec(cname=compression,
+                clevel=complevel, shuffle='shuffle' if shuffle else 'noshuffle')
+        else:
+            opts['compressors'] = None
+        if h['dims'] == ['profile', 'range']:
+            opts['chunks'] = chunksizes if chunksizes is not None else \
+                (CHUNK_PROFILES, max(1, v.shape[1]))
+        elif h['dims'] == ['profile']:
+            # As in write. Automatic chunks are as small as the array written
+            # first.
+            opts['chunks'] = (max(CHUNK_PROFILES_1D,
+                chunksizes[0] if chunksizes is not None else 0),)
+        if var_options is not None:
+            opts.update(var_options.get(k, {}))
+        if dtype == 'S19':
+            var = g.create_array(k, shape=v.shape, dtype=str, fill_value='',
+                dimension_names=h['dims'], **opts)
+            v = v.astype(str)
+        else:
+            var = g.create_array(k, shape=v.shape, dtype=NC_TYPE[dtype],
+                fill_value=FILL_VALUE[dtype], dimension_names=h['dims'],
+                **opts)
+        if v.size > 0:
+            var[...] = v
+        var.attrs.update(var_attrs(k))
+    g.attrs.update(global_attrs(attrs))
+
+def append_zarr(d, filename, attrs=None):
+    import zarr
+    g = zarr.open_group(filename, mode='r+')
+    for k, v in d.items():
+        if 'profile' not in NC_HEADER[k]['dims']:
+            continue
+        var = g[k]
+        v = np.asarray(v)
+        if var.dtype.kind == 'T':
+            v = v.astype(str)
+        n = var.shape[0]
+        if v.ndim == 2:
+            var.resize((n + v.shape[0], max(var.shape[1], v.shape[1])))
+            var[n:,:v.shape[1]] = v
+        else:
+            var.resize((n + len(v),))
+            var[n:] = v
+    if attrs is not None:
+        g.attrs.update(global_attrs(attrs))
+
+def parquet_table(d, attrs=None):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError('the parquet format requires the pyarrow package (install mpl2nc[parquet])')
+    fields = []
+    columns = []
+    for k, v in d.items():
+        h = NC_HEADER[k]
+        if h['dims'] != ['profile']:
+            continue
+        dtype = h['dtype']
+        metadata = var_attrs(k)
+        metadata['_FillValue'] = FILL_VALUE[dtype]
+        v = np.asarray(v)
+        if dtype == 'S19':
+            v = v.astype(str)
+            type_ = pa.string()
+        else:
+            v = v.astype(dtype, copy=False)
+            type_ = pa.from_numpy_dtype(v.dtype)
+        fields.append(pa.field(k, type_, metadata={
+            x: str(y) for x, y in metadata.items()
+        }))
+        columns.append(pa.array(v, type_))
+    if len(fields) == 0:
+        raise ValueError('the parquet format supports only per-profile variables')
+    schema = pa.schema(fields, metadata={
+        k: str(v) for k, v in global_attrs(attrs).items()
+    })
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def write_parquet_part(d, filename, attrs=None, compression='zlib',
+    complevel=4):
+    import pyarrow.parquet as pq
+    table = parquet_table(d, attrs)
+    i = len([x for x in os.listdir(filename) if x.endswith('.parquet')])
+    pq.write_table(table, os.path.join(filename, 'part-%05d.parquet' % i),
+        compression={'zlib': 'gzip', None: 'none'}.get(compression,
+            compression),
+        compression_level=complevel if compression is not None else None,
+    )
+
+def write_parquet(d, filename, attrs=None, compression='zlib', complevel=4,
+    shuffle=True, chunksizes=None, nrb_dtype='float64', var_options=None):
+    if os.path.isdir(filename):
+        for name in os.listdir(filename):
+            if name.endswith('.parquet'):
+                os.remove(os.path.join(filename, name))
+    else:
+        os.makedirs(filename)
+    write_parquet_part(d, filename, attrs, compression, complevel)
+
+def append_parquet(d, filename, attrs=None, compression='zlib', complevel=4):
+    write_parquet_part(d, filename, attrs, compression, complevel)
+
+# Output formats. write takes the write options, append only those listed
+# in append_options.
+WRITERS = {
+    'netcdf': {
+        'write': write,
+        'append': append,
+        'append_options': [],
+        'extension': '.nc',
+    },
+    'zarr': {
+        'write': write_zarr,
+        'append': append_zarr,
+        'append_options': [],
+        'extension': '.zarr',
+    },
+    'parquet': {
+        'write': write_parquet,
+        'append': append_parquet,
+        'append_options': ['compression', 'complevel'],
+        'extension': '.parquet',
+    },
+}
+
+def write_output(d, filename, attrs=None, format='netcdf', **options):
+    WRITERS[format]['write'](d, filename, attrs, **options)
+
+def append_output(d, filename, attrs=None, format='netcdf', **options):
+    writer = WRITERS[format]
+    writer['append'](d, filename, attrs, **{k: options[k]
+        for k in writer['append_options'] if k in options})
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def reset_peak_rss():
+    # Reset the peak resident set size of the process (Linux 4.0 or later).
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+def file_size(filename):
+    if os.path.isdir(filename):
+        return sum(os.path.getsize(os.path.join(dirname, name))
+            for dirname, _, names in os.walk(filename) for name in names)
+    return os.path.getsize(filename) if os.path.exists(filename) else 0
+
+class Stats:
+    # Stages which are running, possibly in different threads. The peak
+    # resident set size is reset only when no other stage is running, so
+    # the peak memory of overlapping stages includes all of them.
+    running = 0
+    lock = threading.Lock()
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = {}
+
+    @contextlib.contextmanager
+    def stage(self, filename, name):
+        info = {'bytes_read': 0, 'bytes_written': 0, 'profiles': 0}
+        with Stats.lock:
+            measured = Stats.running > 0 or reset_peak_rss()
+            Stats.running += 1
+        t0 = tm.perf_counter()
+        c0 = tm.thread_time()
+        try:
+            yield info
+        finally:
+            with Stats.lock:
+                Stats.running -= 1
+        filename = info.pop('file', filename)
+        if filename is None:
+            return
+        rec = self.records.setdefault((filename, name), {
+            'file': filename,
+            'stage': name,
+            'wall_time': 0.,
+            'cpu_time': 0.,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'profiles': 0,
+            'peak_memory': None,
+        })
+        rec['wall_time'] += tm.perf_counter() - t0
+        rec['cpu_time'] += tm.thread_time() - c0
+        for k, v in info.items():
+            rec[k] += v
+        peak = peak_rss() if measured else None
+        if peak is not None:
+            rec['peak_memory'] = max(rec['peak_memory'] or 0, peak)
+        rec['process_peak_memory'] = peak_memory()
+
+    def flush(self, filename):
+        keys = [k for k in self.records if k[0] == filename]
+        records = [self.records.pop(k) for k in keys]
+        if self.callback is not None:
+            for rec in records:
+                self.callback(rec)
+        return records
+
+def window_empty(filename, read_options):
+    # The input file has profiles, but none in the time window.
+    return ('start' in read_options or 'end' in read_options) and \
+        first_time(filename) is not None
+
+def convert_read(filename, stats, read_options={}):
+    with stats.stage(filename, 'read') as info:
+        mpl = read_mpl(filename, **read_options)
+        if len(read_options) > 0:
+            info['bytes_read'] = len(mpl['time'])* \
+                mpl_dtype(mpl['channel_1'].shape[1]).itemsize
+        else:
+            info['bytes_read'] = os.path.getsize(filename)
+        info['profiles'] = len(mpl['time'])
+    if len(mpl['time']) == 0:
+        if window_empty(filename, read_options):
+            return None
+        raise IOError('no profiles found in the input file')
+    return mpl
+
+def convert_process(filename, mpl, d, stats, average_options={}):
+    if len(average_options) > 0:
+        with stats.stage(filename, 'average') as info:
+            info['profiles'] = len(mpl['time'])
+            mpl = average(mpl, **average_options)
+    mpl.update(d)
+    with stats.stage(filename, 'nrb') as info:
+        process_nrb(mpl)
+        info['profiles'] = len(mpl['time'])
+    return mpl
+
+def convert_write(filename, mpl, output_filename, stats, write_options={}):
+    with stats.stage(filename, 'write') as info:
+        write_output(mpl, output_filename, **write_options)
+        info['bytes_written'] = file_size(output_filename)
+        info['profiles'] = len(mpl['time'])
+
+def convert(filename, output_filename, d, chunk_size=None,
+    write_options={}, stats=None, read_options={}, average_options={}):
+    if stats is None:
+        stats = Stats()
+    try:
+        if chunk_size is not None:
+            return convert_chunked(filename, output_filename, d, chunk_size,
+                write_options, stats, read_options, average_options)
+        mpl = convert_read(filename, stats, read_options)
+        if mpl is None:
+            return False
+        mpl = convert_process(filename, mpl, d, stats, average_options)
+        convert_write(filename, mpl, output_filename, stats, write_options)
+        return True
+    finally:
+        stats.flush(filename)
+
+def select_profiles(d, mask):
+    return {k: v[mask] if 'profile' in NC_HEADER[k]['dims'] else v
+        for k, v in d.items()}
+
+def first_time(filename):
+    with open(filename, 'rb') as f:
+        d = read_header(f, HEADER_MPL)
+    return time(d) if d is not None else None
+
+def convert_chunked(filename, output_filename, d, chunk_size,
+    write_options={}, stats=None, read_options={}, average_options={}):
+    chunks = ((filename, mpl)
+        for mpl in read_mpl_chunks(filename, chunk_size, **read_options))
+    if convert_chunks(chunks, output_filename, d, write_options, stats,
+        average_options=average_options) == 0:
+        if window_empty(filename, read_options):
+            return False
+        raise IOError('no profiles found in the input file')
+    return True
+
+def convert_merge(filenames, output_filename, d, chunk_size=CHUNK_SIZE,
+    write_options={}, stats=None, read_options={}, average_options={}):
+    if stats is None:
+        stats = Stats()
+    try:
+        times = [(first_time(filename), filename) for filename in filenames]
+        times = sorted(x for x in times if x[0] is not None)
+        filenames = [x[1] for x in times]
+        chunks = merge_chunks([(filename, t,
+            read_mpl_chunks(filename, chunk_size, **read_options))
+            for t, filename in times])
+        n = convert_chunks(chunks, output_filename, d, write_options, stats,
+            average_options=average_options)
+        if n == 0:
+            raise IOError('no profiles found in the input files')
+        return n
+    finally:
+        for filename in filenames:
+            stats.flush(filename)
+
+def concat_chunks(chunks):
+    return {k: np.concatenate([x[k] for x in chunks])
+        if 'profile' in NC_HEADER[k]['dims'] else v
+        for k, v in chunks[-1].items()}
+
+def merge_chunks(streams):
+    # Merge streams of (filename, time of the first profile, chunks) sorted by
+    # the time of the first profile into chunks in the order of time, where
+    # the profiles of every file are in the order of time. A file is read
+    # only when its first profile can be next, and at most one chunk of every
+    # file being read is kept in memory. Of profiles with the same time, only
+    # the one from the earliest stream is kept. Profiles earlier than
+    # profiles already merged (if a file is not in the order of time) are
+    # skipped.
+    streams = collections.deque(streams)
+    active = []
+    buffers = {}
+    last = -1
+    while True:
+        for filename, chunks in active:
+            if filename not in buffers:
+                mpl = next(chunks, None)
+                if mpl is not None:
+                    buffers[filename] = select_profiles(mpl, np.argsort(
+                        mpl['time'].astype(np.int64), kind='stable'))
+        active = [x for x in active if x[0] in buffers]
+        if len(streams) > 0 and (len(active) == 0 or streams[0][1] <= min(
+            int(b['time'][-1]) for b in buffers.values())):
+            filename, _, chunks = streams.popleft()
+            active.append((filename, iter(chunks)))
+            continue
+        if len(active) == 0:
+            break
+        # Later chunks of a file do not contain profiles before the end of
+        # its current chunk, so profiles up to the earliest end are final.
+        limit = min(int(b['time'][-1]) for b in buffers.values())
+        parts = []
+        for filename, _ in active:
+            mpl = buffers.pop(filename)
+            t = mpl['time'].astype(np.int64)
+            parts.append((filename, select_profiles(mpl, t <= limit)))
+            if t[-1] > limit:
+                buffers[filename] = select_profiles(mpl, t > limit)
+        t = np.concatenate([x[1]['time'].astype(np.int64) for x in parts])
+        k = np.concatenate([np.full(len(x[1]['time']), i)
+            for i, x in enumerate(parts)])
+        i = np.concatenate([np.arange(len(x[1]['time'])) for x in parts])
+        order = np.argsort(t, kind='stable')
+        t, k, i = t[order], k[order], i[order]
+        mask = t > np.concatenate([[last], t[:-1]])
+        t, k, i = t[mask], k[mask], i[mask]
+        if len(t) == 0:
+            continue
+        last = int(t[-1])
+        # Profiles with a different number of bins cannot be concatenated,
+        # so they are returned in separate chunks.
+        bins = np.array([x[1]['channel_1'].shape[1] for x in parts])
+        starts = np.flatnonzero(np.diff(bins[k], prepend=-1, append=-1))
+        for a, b in zip(starts[:-1], starts[1:]):
+            same = np.flatnonzero(bins == bins[k[a]])
+            offsets = np.zeros(len(parts), np.int64)
+            offsets[same] = np.cumsum([0] + [len(parts[x][1]['time'])
+                for x in same[:-1]])
+            mpl = concat_chunks([parts[x][1] for x in same])
+            yield parts[k[a]][0], select_profiles(mpl,
+                offsets[k[a:b]] + i[a:b])
+
+def convert_chunks(chunks, output_filename, d, write_options={}, stats=None,
+    average_options={}):
+    if stats is None:
+        stats = Stats()
+    n = 0
+    filename = None
+    carry = None
+    interval = average_options.get('interval')
+    while True:
+        with stats.stage(None, 'read') as info:
+            next_filename, mpl = next(chunks, (None, None))
+            info['file'] = next_filename
+            if mpl is not None:
+                info['bytes_read'] = len(mpl['time'])* \
+                    mpl_dtype(mpl['channel_1'].shape[1]).itemsize
+                info['profiles'] = len(mpl['time'])
+        if mpl is None and carry is None:
+            break
+        if mpl is not None:
+            filename = next_filename
+        if len(average_options) > 0:
+            with stats.stage(filename, 'average') as info:
+                if carry is not None:
+                    mpl = carry if mpl is None else concat_profiles(carry, mpl)
+                    carry = None
+                if next_filename is not None and interval is not None:
+                    # The last time bin can continue in the next chunk.
+                    mpl, carry = split_last_bin(mpl, interval)
+                info['profiles'] = len(mpl['time'])
+                mpl = average(mpl, **average_options)
+            if len(mpl['time']) == 0:
+                continue
+        mpl.update(d)
+        with stats.stage(filename, 'nrb') as info:
+            process_nrb(mpl)
+            info['profiles'] = len(mpl['time'])
+        with stats.stage(filename, 'write') as info:
+            if n == 0:
+                size = 0
+                write_output(mpl, output_filename, **write_options)
+            else:
+                size = file_size(output_filename)
+                append_output(mpl, output_filename, **write_options)
+            info['bytes_written'] = file_size(output_filename) - size
+            info['profiles'] = len(mpl['time'])
+        n += len(mpl['time'])
+    return n
+
+def convert_tail(filename, output_filename, d, write_options={}, stats=None):
+    from netCDF4 import Dataset
+    if stats is None:
+        stats = Stats()
+    exists = os.path.exists(output_filename)
+    offset = 0
+    if exists:
+        with Dataset(output_filename) as f:
+            if 'input_offset' not in f.ncattrs():
+                raise IOError('%s: input offset not found (the file was not created in append mode)' % output_filename)
+            offset = int(f.input_offset)
+    try:
+        with stats.stage(filename, 'read') as info:
+            dd, new_offset = read_mpl_tail(filename, offset)
+            info['bytes_read'] = new_offset - offset
+            info['profiles'] = len(dd)
+        if len(dd) == 0:
+            # Nothing to report when no new profiles were found.
+            stats.records.pop((filename, 'read'), None)
+            return 0
+        with stats.stage(filename, 'nrb') as info:
+            mpl = process_mpl(dd)
+            mpl.update(d)
+            process_nrb(mpl)
+            info['profiles'] = len(dd)
+        attrs = {'input_offset': np.int64(new_offset)}
+        with stats.stage(filename, 'write') as info:
+            size = file_size(output_filename) if exists else 0
+            if exists:
+                append_output(mpl, output_filename, attrs, **write_options)
+            else:
+                write_output(mpl, output_filename, attrs, **write_options)
+            info['bytes_written'] = file_size(output_filename) - size
+            info['profiles'] = len(dd)
+    finally:
+        stats.flush(filename)
+    return len(dd)
+
+WORKER_CORRECTIONS = None
+
+def init_worker(d):
+    global WORKER_CORRECTIONS
+    WORKER_CORRECTIONS = d
+
+def convert_worker(filename, output_filename, **kwargs):
+    records = []
+    converted = convert(filename, output_filename, WORKER_CORRECTIONS,
+        stats=Stats(records.append), **kwargs)
+    return converted, records
+
+def convert_parallel(tasks, d, jobs, **kwargs):
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+        initargs=(d,)) as executor:
+        futures = [executor.submit(convert_worker, *task, **kwargs)
+            for task in tasks]
+        for task, future in zip(tasks, futures):
+            e = future.exception()
+            converted, records = future.result() if e is None else (False, [])
+            yield task[0], e, records, converted
+
+def convert_pipeline(tasks, d, depth=2, write_options={}, read_options={},
+    average_options={}):
+    from concurrent.futures import Future, ThreadPoolExecutor
+    # Inputs are read ahead by a pool of depth threads. NRB is calculated in
+    # the calling thread. Outputs are written by a single writer thread,
+    # because HDF5 is not thread-safe. The netCDF4 module releases the GIL
+    # during most of the writing. At most depth files are queued for
+    # writing.
+    tasks = iter(tasks)
+    reads = collections.deque()
+    writes = collections.deque()
+
+    def read_next(executor):
+        task = next(tasks, None)
+        if task is not None:
+            records = []
+            stats = Stats(records.append)
+            future = executor.submit(convert_read, task[0], stats,
+                read_options)
+            reads.append((task, future, stats, records))
+
+    def finish():
+        task, future, stats, records, converted = writes.popleft()
+        e = future.exception()
+        stats.flush(task[0])
+        return task[0], e, (records if e is None else []), \
+            converted and e is None
+
+    with ThreadPoolExecutor(max_workers=depth) as reader, \
+        ThreadPoolExecutor(max_workers=1) as writer:
+        for i in range(depth):
+            read_next(reader)
+        while len(reads) > 0:
+            task, future, stats, records = reads.popleft()
+            read_next(reader)
+            converted = False
+            try:
+                mpl = future.result()
+                if mpl is not None:
+                    mpl = convert_process(task[0], mpl, d, stats,
+                        average_options)
+                    future = writer.submit(convert_write, task[0], mpl,
+                        task[1], stats, write_options)
+                    converted = True
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            writes.append((task, future, stats, records, converted))
+            while len(writes) > depth or \
+                (len(writes) > 0 and writes[0][1].done()):
+                yield finish()
+        while len(writes) > 0:
+            yield finish()
+
+class WorkerPool:
+    def __init__(self, d, jobs=1):
+        self.d = d
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.isolate_lock = threading.Lock()
+        self.running = 0
+        self.isolated = 0
+        self.executor = self.start()
+
+    def start(self):
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=self.jobs,
+            initializer=init_worker, initargs=(self.d,))
+        # Start the workers before accepting jobs.
+        for future in [executor.submit(int) for i in range(self.jobs)]:
+            future.result()
+        return executor
+
+    def restart(self, executor):
+        with self.lock:
+            # Jobs which failed on the same broken executor restart it only
+            # once.
+            if self.executor is executor:
+                # Wait until the remaining workers are terminated, so that
+                # they do not hold output files which are written again.
+                executor.shutdown()
+                self.executor = self.start()
+
+    def submit(self, func, *args, **kwargs):
+        from concurrent.futures.process import BrokenProcessPool
+        executor = self.executor
+        try:
+            return executor.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise
+
+    def run(self, func, *args, **kwargs):
+        from concurrent.futures.process import BrokenProcessPool
+        # When a worker process dies, all jobs running on the executor fail
+        # and it cannot be used anymore. It is not known which of the jobs
+        # caused it, so every failed job is run again alone on a new
+        # executor, while no other jobs are running. A job fails only if it
+        # terminates a worker process when running alone.
+        with self.cond:
+            self.cond.wait_for(lambda: self.isolated == 0)
+            self.running += 1
+        try:
+            return self.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            pass
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+        with self.cond:
+            self.isolated += 1
+        try:
+            with self.isolate_lock:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.running == 0)
+                try:
+                    return self.submit(func, *args, **kwargs)
+                except BrokenProcessPool:
+                    raise IOError('worker process terminated unexpectedly')
+        finally:
+            with self.cond:
+                self.isolated -= 1
+                self.cond.notify_all()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def serve_job(pool, line, **kwargs):
+    t0 = tm.perf_counter()
+    res = {}
+    try:
+        job = json.loads(line)
+        if not isinstance(job, dict) or 'input' not in job or \
+            'output' not in job:
+            raise ValueError('job must contain "input" and "output"')
+        res['input'] = job['input']
+        res['output'] = job['output']
+        converted, res['stats'] = pool.run(convert_worker, job['input'],
+            job['output'], **kwargs)
+        res['status'] = 'ok' if converted else 'skipped'
+    except Exception as e:
+        res['status'] = 'error'
+        res['error'] = str(e)
+    res['wall_time'] = tm.perf_counter() - t0
+    return res
+
+def serve(path, d, jobs=1, callback=None, **kwargs):
+    import socket
+    import socketserver
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(path)
+            except OSError:
+                os.remove(path)
+            else:
+                raise IOError('%s: server already running' % path)
+    pool = WorkerPool(d, jobs)
+    try:
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    res = serve_job(pool, line, **kwargs)
+                    if callback is not None:
+                        callback(res)
+                    self.wfile.write((json.dumps(res) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            # Remove the socket on termination.
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                signal.signal(sig, lambda *args: sys.exit(0))
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(path)
+    finally:
+        pool.shutdown()
+
+def submit(path, filename, output_filename):
+    import socket
+    job = {
+        'input': os.path.abspath(filename),
+        'output': os.path.abspath(output_filename),
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if len(line) == 0:
+        raise IOError('%s: no response from server' % path)
+    return json.loads(line)
+
+def file_stat(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+def corrections_fingerprint(filenames, options={}):
+    h = hashlib.sha1(__version__.encode('utf-8'))
+    for filename in filenames:
+        if filename is None:
+            h.update(b'\0')
+            continue
+        with open(filename, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    # Conversion options which change the output, e.g. {'read': ...,
+    # 'average': ..., 'write': ...}. Times are hashed as ISO 8601 strings.
+    h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+def read_manifest(dirname, fingerprint):
+    try:
+        with open(os.path.join(dirname, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if manifest.get('corrections') != fingerprint:
+        return {}
+    return manifest.get('files', {})
+
+def write_manifest(dirname, fingerprint, files):
+    filename = os.path.join(dirname, MANIFEST)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'corrections': fingerprint, 'files': files}, f,
+            indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+def is_up_to_date(files, filename, output_filename, stat):
+    return files.get(os.path.basename(filename)) == stat and \
+        os.path.exists(output_filename)
+
+def print_error(e, debug, filename=None):
+    if debug:
+        traceback.print_exception(type(e), e, e.__traceback__)
+    elif filename is not None:
+        print('Error: %s: %s. Use --debug for more information.' % \
+            (filename, str(e)), file=sys.stderr)
+    else:
+        print('Error: %s. Use --debug for more information.' % str(e),
+            file=sys.stderr)
+
 def main2(args):
-    if args.input is None and \
+    if args.submit is not None:
+        if args.input is None:
+            raise ValueError('--submit requires input and output')
+        res = submit(args.submit, args.input, args.output)
+        if not args.quiet:
+            print(json.dumps(res))
+        if res['status'] == 'error':
+            raise IOError('%s: %s' % (args.input, res['error']))
+        return
+
+    if args.serve is None and \
+        args.input is None and \
         args.afterpulse is None and \
         args.overlap is None and \
         args.dead_time is None:
@@ -388,19 +1782,20 @@ def main2(args):
     dead_time = None
 
     if args.afterpulse is not None:
-        with open(args.afterpulse[0], 'rb') as f:
-            afterpulse = read_afterpulse(f)
+        afterpulse = read_correction(args.afterpulse[0], 'afterpulse',
+            cache=args.cache)
 
     if args.overlap is not None:
-        with open(args.overlap[0], 'rb') as f:
-            overlap = read_overlap(f)
+        overlap = read_correction(args.overlap[0], 'overlap',
+            cache=args.cache)
 
     if args.dead_time is not None:
         if args.dead_time[0].endswith('.csv'):
-            dead_time = read_dt_csv(args.dead_time[0])
+            dead_time = read_correction(args.dead_time[0], 'dead_time_csv',
+                cache=args.cache)
         else:
-            with open(args.dead_time[0], 'rb') as f:
-                dead_time = read_dt(f)
+            dead_time = read_correction(args.dead_time[0], 'dead_time',
+                cache=args.cache)
 
     d = {}
     if afterpulse is not None:
@@ -410,27 +1805,189 @@ def main2(args):
     if dead_time is not None:
         d.update(dead_time)
 
-    if args.input is None:
-        write(d, args.output)
-    else:
-        if os.path.isdir(args.input):
-            for name in sorted(os.listdir(args.input)):
-                filename = os.path.join(args.input, name)
-                output_filename = os.path.join(
-                    args.output,
-                    os.path.splitext(name)[0] + '.nc'
-                )
-                if not args.quiet:
+    write_options = {
+        'compression': args.compression if args.compression != 'none' \
+            else None,
+        'complevel': args.complevel,
+        'shuffle': args.shuffle,
+        'chunksizes': args.nc_chunks,
+        'nrb_dtype': 'float32' if args.nrb_float32 else 'float64',
+        'format': args.format,
+    }
+
+    read_options = {k: getattr(args, k)
+        for k in ['start', 'end', 'max_bins', 'max_range']
+        if getattr(args, k) is not None
+    }
+    if args.max_bins is not None and args.max_bins < 1:
+        raise ValueError('maximum number of range bins must be at least 1')
+    if args.max_range is not None and not args.max_range > 0:
+        raise ValueError('maximum range must be positive')
+
+    average_options = {}
+    if args.average is not None:
+        if args.average < 1:
+            raise ValueError('averaging interval must be at least 1 second')
+        average_options['interval'] = args.average
+    if args.average_range is not None:
+        if args.average_range < 1:
+            raise ValueError('number of range bins to average must be at least 1')
+        average_options['range_factor'] = args.average_range
+
+    if args.chunk_size is not None and args.chunk_size < 1:
+        raise ValueError('chunk size must be at least 1')
+
+    if args.pipeline is not None:
+        if args.pipeline < 1:
+            raise ValueError('pipeline depth must be at least 1')
+        if args.chunk_size is not None or args.jobs > 1:
+            raise ValueError('--pipeline cannot be used with -c or -j')
+        if args.merge or args.serve is not None or args.input is None or \
+            not os.path.isdir(args.input):
+            raise ValueError('--pipeline requires an input directory')
+
+    with contextlib.ExitStack() as stack:
+        stats = None
+        if args.stats is not None:
+            stats_file = sys.stdout if args.stats == '-' else \
+                stack.enter_context(open(args.stats, 'w'))
+            def stats_callback(rec):
+                stats_file.write(json.dumps(rec) + '\n')
+                stats_file.flush()
+            stats = Stats(stats_callback)
+
+        if args.serve is not None:
+            if args.input is not None:
+                raise ValueError('input and output cannot be specified with --serve')
+            def serve_callback(res):
+                filename = res.get('input')
+                if not args.quiet and filename is not None:
                     print(filename)
-                mpl = read_mpl(filename)
-                mpl.update(d)
-                process_nrb(mpl)
-                write(mpl, output_filename)
+                if res['status'] == 'error':
+                    print('Error: %s' % (res['error'] if filename is None else
+                        '%s: %s' % (filename, res['error'])), file=sys.stderr)
+                if stats is not None:
+                    for rec in res.get('stats', []):
+                        stats.callback(rec)
+            serve(args.serve, d, args.jobs, serve_callback,
+                chunk_size=args.chunk_size,
+                write_options=write_options,
+                read_options=read_options,
+                average_options=average_options,
+            )
+        elif args.input is None:
+            write_output(d, args.output, **write_options)
         else:
-            mpl = read_mpl(args.input)
-            mpl.update(d)
-            process_nrb(mpl)
-            write(mpl, args.output)
+            if args.merge:
+                if os.path.isdir(args.input):
+                    filenames = [os.path.join(args.input, name)
+                        for name in sorted(os.listdir(args.input))]
+                else:
+                    filenames = sorted(glob.glob(args.input))
+                filenames = [x for x in filenames if not x.endswith(INDEX_SUFFIX)]
+                if len(filenames) == 0:
+                    raise IOError('no input files found')
+                convert_merge(filenames, args.output, d,
+                    chunk_size=args.chunk_size if args.chunk_size is not None \
+                        else CHUNK_SIZE,
+                    write_options=write_options,
+                    stats=stats,
+                    read_options=read_options,
+                    average_options=average_options,
+                )
+            elif os.path.isdir(args.input):
+                tasks = []
+                for name in sorted(os.listdir(args.input)):
+                    if name.endswith(INDEX_SUFFIX):
+                        continue
+                    filename = os.path.join(args.input, name)
+                    output_filename = os.path.join(
+                        args.output,
+                        os.path.splitext(name)[0] + \
+                            WRITERS[args.format]['extension']
+                    )
+                    tasks.append((filename, output_filename))
+                if args.incremental:
+                    fingerprint = corrections_fingerprint([
+                        x[0] if x is not None else None
+                        for x in [args.afterpulse, args.overlap, args.dead_time]
+                    ], {
+                        'read': read_options,
+                        'average': average_options,
+                        'write': write_options,
+                    })
+                    files = read_manifest(args.output, fingerprint)
+                    file_stats = {x[0]: file_stat(x[0]) for x in tasks}
+                    tasks = [x for x in tasks
+                        if not is_up_to_date(files, *x, file_stats[x[0]])]
+                done = []
+                try:
+                    results = None
+                    if args.jobs > 1:
+                        results = convert_parallel(tasks, d, args.jobs,
+                            chunk_size=args.chunk_size,
+                            write_options=write_options,
+                            read_options=read_options,
+                            average_options=average_options)
+                    elif args.pipeline is not None:
+                        results = convert_pipeline(tasks, d, args.pipeline,
+                            write_options=write_options,
+                            read_options=read_options,
+                            average_options=average_options)
+                    if results is not None:
+                        for filename, e, records, converted in results:
+                            if not args.quiet:
+                                print(filename)
+                            if e is not None:
+                                print_error(e, args.debug, filename)
+                            elif converted:
+                                done.append(filename)
+                            if stats is not None:
+                                for rec in records:
+                                    stats.callback(rec)
+                    else:
+                        for filename, output_filename in tasks:
+                            if not args.quiet:
+                                print(filename)
+                            # Files without profiles in the time window are
+                            # skipped and not recorded in the manifest.
+                            if convert(filename, output_filename, d,
+                                chunk_size=args.chunk_size,
+                                write_options=write_options,
+                                stats=stats,
+                                read_options=read_options,
+                                average_options=average_options):
+                                done.append(filename)
+                finally:
+                    if args.incremental and len(done) > 0:
+                        for filename in done:
+                            files[os.path.basename(filename)] = \
+                                file_stats[filename]
+                        write_manifest(args.output, fingerprint, files)
+            elif args.append or args.follow is not None:
+                if args.format != 'netcdf':
+                    raise ValueError('--append and --follow support only the netcdf format')
+                if len(read_options) > 0 or len(average_options) > 0:
+                    raise ValueError('--start, --end, --max-bins, --max-range, --average and --average-range cannot be used with --append or --follow')
+                while True:
+                    convert_tail(args.input, args.output, d, write_options,
+                        stats)
+                    if args.follow is None:
+                        break
+                    tm.sleep(args.follow)
+            else:
+                convert(args.input, args.output, d, chunk_size=args.chunk_size,
+                    write_options=write_options, stats=stats,
+                    read_options=read_options, average_options=average_options)
+
+def parse_chunks(s):
+    chunks = tuple(int(x) for x in s.split(','))
+    if len(chunks) != 2 or min(chunks) < 1:
+        raise ValueError('invalid chunk shape')
+    return chunks
+
+def parse_time(s):
+    return np.datetime64(s, 's')
 
 def main():
     p = argparse.ArgumentParser(prog='mpl2nc',
@@ -438,33 +1995,102 @@ def main():
     )
     p.add_argument('-a', nargs=1, dest='afterpulse',
         help='afterpulse correction file (".bin")')
+    p.add_argument('--average', dest='average', type=int, metavar='SECONDS',
+        help='average profiles over time intervals of SECONDS seconds weighted by the number of shots')
+    p.add_argument('--average-range', dest='average_range', type=int,
+        metavar='N', help='average every N range bins')
+    p.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+        metavar='N',
+        help='convert N profiles at a time to limit memory usage (default: convert the whole file at once)')
+    p.add_argument('--compression', dest='compression',
+        choices=['none', 'zlib', 'zstd'], default='zlib',
+        help='NetCDF compression (default: zlib)')
+    p.add_argument('--complevel', dest='complevel', type=int, default=4,
+        help='NetCDF compression level (default: 4)')
     p.add_argument('-d', nargs=1, dest='dead_time',
         help='dead time correction file (".bin" or ".csv")')
+    p.add_argument('--end', dest='end', type=parse_time, metavar='TIME',
+        help='convert only profiles before TIME (UTC, ISO 8601, e.g. 2018-03-04T12:00:00)')
+    p.add_argument('--format', dest='format',
+        choices=['netcdf', 'zarr', 'parquet'], default='netcdf',
+        help='output format (default: netcdf)')
+    p.add_argument('-f', '--follow', dest='follow', type=float,
+        metavar='INTERVAL',
+        help='like --append, but keep checking the input file for new profiles every INTERVAL seconds')
+    p.add_argument('-i', '--incremental', dest='incremental',
+        action='store_true',
+        help='when input is a directory, skip files which have not changed since the last conversion')
+    p.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+        help='number of files to convert in parallel when input is a directory (default: 1)')
+    p.add_argument('-m', '--merge', dest='merge', action='store_true',
+        help='merge all files in the input directory or matching the input glob pattern into a single output file')
+    p.add_argument('--max-bins', dest='max_bins', type=int, metavar='N',
+        help='convert only the first N range bins of every profile')
+    p.add_argument('--max-range', dest='max_range', type=float, metavar='KM',
+        help='convert only range bins up to KM km')
+    p.add_argument('--nc-chunks', dest='nc_chunks', type=parse_chunks,
+        metavar='PROFILE,RANGE',
+        help='NetCDF chunk shape of the profile × range variables (default: %d,number of bins)' % CHUNK_PROFILES)
+    p.add_argument('--no-cache', dest='cache', action='store_false',
+        help='do not cache parsed correction files')
+    p.add_argument('--no-shuffle', dest='shuffle', action='store_false',
+        help='disable the NetCDF shuffle filter')
+    p.add_argument('--nrb-float32', dest='nrb_float32', action='store_true',
+        help='store NRB as float32 instead of float64')
     p.add_argument('-o', nargs=1, dest='overlap',
         help='overlap correction file (".bin")')
+    p.add_argument('--append', dest='append', action='store_true',
+        help='append profiles added to the input file since the last run to the output file')
+    p.add_argument('--pipeline', dest='pipeline', type=int, metavar='DEPTH',
+        help='when input is a directory, read up to DEPTH files ahead and write up to DEPTH files in a background thread while calculating NRB')
+    p.add_argument('--profile', dest='profile', metavar='FILE',
+        help='write cProfile statistics of the main process to FILE')
     p.add_argument('-q', dest='quiet', action='store_true',
         help='run quietly (suppress output)')
+    p.add_argument('--start', dest='start', type=parse_time, metavar='TIME',
+        help='convert only profiles at or after TIME (UTC, ISO 8601, e.g. 2018-03-04T06:00:00)')
+    p.add_argument('--serve', dest='serve', metavar='SOCKET',
+        help='run as a server converting files submitted to the Unix socket SOCKET with the correction files loaded once and -j worker processes kept running')
+    p.add_argument('--stats', dest='stats', metavar='FILE',
+        help='write timing, I/O and memory statistics of every conversion stage to FILE as JSON lines ("-" for standard output)')
+    p.add_argument('--submit', dest='submit', metavar='SOCKET',
+        help='submit input to a server running on the Unix socket SOCKET to be converted to output, and print the result as JSON')
     p.add_argument('-v', action='version', version=__version__)
     p.add_argument('--debug', dest='debug', action='store_true',
         help='print debugging information'
     )
     p.add_argument('input', help='input file or directory (".mpl")', nargs='?')
-    p.add_argument('output', help='output file or directory (NetCDF)')
+    p.add_argument('output', help='output file or directory (NetCDF)',
+        nargs='?')
 
     args = p.parse_args()
 
+    if args.output is None and args.serve is None:
+        if args.input is None:
+            p.error('the following arguments are required: output')
+        args.output = args.input
+        args.input = None
+
     if not args.debug:
         warnings.formatwarning = lambda msg, *args, **kwargs: \
             'Warning: %s. Use --debug for more information.\n' % str(msg)
 
+    if args.profile is not None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
     try:
         main2(args)
     except Exception as e:
         if args.debug:
             raise e
         else:
-            print('Error: %s. Use --debug for more information.' % str(e),
-                file=sys.stderr)
+            print_error(e, args.debug)
+    finally:
+        if args.profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
 
 if __name__ == '__main__':
     main()
@@ -19,6 +19,10 @@ setup(
         'netCDF4>=1.2.9',
         'ds-format>=4.1.0',
 	],
+    extras_require={
+        'zarr': ['zarr>=3'],
+        'parquet': ['pyarrow'],
+    },
     keywords=['sigmaspace', 'mpl', 'lidar', 'netcdf'],
     url='https://github.com/peterkuma/mpl2nc',
     classifiers=[